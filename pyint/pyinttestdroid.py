@@ -4,22 +4,57 @@
 """
 
 import os
+import atexit
 import signal
 import subprocess
 import threading
 import sys
 import re
+import json
+import zipfile
+import tempfile
+import cPickle
+import hashlib
+import pipes
+import tarfile
+import zlib
 import fdpexpect
 
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from pexpect import ExceptionPexpect
 from time import strftime, localtime, sleep, time
 
 TOLERANCE = 0.92
 
+SESSION_INDEX = "session.json"
+SIDE_EFFECT_KEY = "{SIDE_EFFECT}"
+SIDE_EFFECT_COMMAND = re.compile(r"^(?:adb -s \S+ shell input |irsend )")
+
+SHARED_MEMORY_PATH = "/dev/shm"
+
+MATCH_TEMPLATE = "template"
+MATCH_KEYPOINTS = "keypoints"
+
+KEYPOINT_FEATURES = 5000
+KEYPOINT_MIN_MATCHES = 10
+KEYPOINT_RATIO = 0.75
+KEYPOINT_PADDING = 31
+
+TRANSFER_CHUNK_SIZE = 32 * 1024 * 1024
+TRANSFER_CHUNK_FILES = 256
+TREE_LIST_MARKER = "PYINT_TREE_LISTED"
+
 _debug_level = 1
 
 _error_occurred = False
 
+_ocr_api = None
+_ocr_lock = threading.RLock()
+
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
 class DeviceInitializationError(Exception):
     """Device initialization error."""
     def __init__(self, msg):
@@ -49,6 +84,371 @@ class AbortError(Exception):
     def __str__(self):
         return repr(self.msg)
 
+class SessionReplayError(Exception):
+    """Recorded session cannot serve the requested command or screenshot."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class SessionRecorder(object):
+    """Records commands, outputs and screenshots into a session archive (zip)"""
+    replaying = False
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.events = []
+        self.frame_count = 0
+        self.archive = zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED)
+        # A run that aborts before teardown still leaves a replayable archive
+        atexit.register(self.close)
+
+    def record_command(self, cmd, output):
+        # latin-1 maps every byte to a code point, so outputs survive json unchanged
+        if output is not None:
+            output = output.decode("latin-1")
+        self.events.append({"cmd": cmd, "output": output})
+
+    def record_frame(self, frame_path):
+        if not os.path.exists(frame_path):
+            debug("No screenshot to record at " + frame_path)
+            return
+
+        self.frame_count += 1
+        name = "frames/%05d.png" % self.frame_count
+        # PNG data is already compressed
+        self.archive.write(frame_path, name, zipfile.ZIP_STORED)
+        self.events.append({"frame": name})
+
+    def close(self):
+        if self.archive is None:
+            return
+
+        self.archive.writestr(SESSION_INDEX, json.dumps({"version": 1, "events": self.events}, indent=1))
+        self.archive.close()
+        self.archive = None
+
+class SessionReplayer(object):
+    """Serves command outputs and screenshots back from a session archive"""
+    replaying = True
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.archive = zipfile.ZipFile(archive_path, "r")
+        self.outputs = defaultdict(deque)
+        self.last_outputs = {}
+        self.frames = deque()
+
+        try:
+            events = json.loads(self.archive.read(SESSION_INDEX))["events"]
+        except (KeyError, ValueError), e:
+            raise SessionReplayError("%s is not a session archive: %s" % (archive_path, str(e)))
+
+        for event in events:
+            if "frame" in event:
+                self.frames.append(event["frame"])
+            else:
+                output = event["output"]
+                if output is not None:
+                    output = output.encode("latin-1")
+                self.outputs[_replay_key(event["cmd"])].append((event["cmd"], output))
+
+    def replay_command(self, cmd):
+        debug("replay cmd = " + cmd)
+        key = _replay_key(cmd)
+
+        if not self.outputs[key]:
+            # Changed test logic may tap or check the device more often than
+            # recorded, so repeat the last answer rather than end the replay
+            if key in self.last_outputs:
+                debug("No recorded output left, repeating the last one for: " + cmd)
+                return self.last_outputs[key]
+            if key == SIDE_EFFECT_KEY:
+                debug("No recorded side effect command left for: " + cmd)
+                return ""
+            raise SessionReplayError("No recorded output for: " + cmd)
+
+        recorded_cmd, output = self.outputs[key].popleft()
+        if recorded_cmd != cmd:
+            debug("replaying %s in place of recorded %s" % (cmd, recorded_cmd))
+        self.last_outputs[key] = output
+        return output
+
+    def replay_frame(self, frame_path):
+        if not self.frames:
+            raise SessionReplayError("No recorded screenshot left for: " + frame_path)
+
+        with open(frame_path, "wb") as frame_file:
+            frame_file.write(self.archive.read(self.frames.popleft()))
+
+    def close(self):
+        self.archive.close()
+
+def _replay_key(cmd):
+    # Side effect commands are replayed in recorded order whatever their
+    # arguments, so a changed tap location does not end the replay
+    if SIDE_EFFECT_COMMAND.search(cmd):
+        return SIDE_EFFECT_KEY
+    return cmd
+
+class SharedFrame(object):
+    """Decoded screenshot held in a reference counted buffer of a FramePool"""
+    def __init__(self, pool, index, shape, dtype):
+        self.pool = pool
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+        self.refcount = 1
+
+    def array(self):
+        """Numpy view of the frame. Only valid while the frame is retained."""
+        nbytes = self.dtype.itemsize
+        for dim in self.shape:
+            nbytes *= dim
+        return self.pool.buffers[self.index][:nbytes].view(self.dtype).reshape(self.shape)
+
+    def handle(self):
+        """Picklable handle that lets other processes map the frame with map_shared_frame"""
+        return (self.pool.paths[self.index], self.shape, self.dtype.str)
+
+    def retain(self):
+        with self.pool.lock:
+            if self.refcount <= 0:
+                raise ValueError("Shared frame was already released")
+            self.refcount += 1
+
+    def release(self):
+        with self.pool.lock:
+            if self.refcount <= 0:
+                raise ValueError("Shared frame was already released")
+            self.refcount -= 1
+            if self.refcount == 0:
+                self.pool.free.append(self.index)
+                self.pool.lock.notify()
+
+class FramePool(object):
+    """Bounded pool of reusable shared memory buffers for screenshots. Buffers are
+    files on a memory backed file system so worker processes can map them by path.
+    Use it as a context manager so the buffers are removed even if a test fails:
+
+      with FramePool(3840 * 2160 * 3) as frame_pool:
+          frame = device_under_test.take_shared_screenshot("IMAGE", folder, frame_pool)
+          results = parallel_sub_image_search(process_pool, frame, template_paths)
+          frame.release()
+
+    Buffers still open when the interpreter exits are removed as well."""
+    def __init__(self, buffer_size, buffer_count=4, directory=SHARED_MEMORY_PATH):
+        try:
+            import numpy
+        except:
+            raise ImportError("numpy library required. Type \"sudo apt-get install python-numpy\" to install")
+
+        if not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+
+        self.buffer_size = buffer_size
+        self.lock = threading.Condition()
+        self.paths = []
+        self.buffers = []
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+        for i in range(buffer_count):
+            fd, path = tempfile.mkstemp(prefix="pyint_frame_", dir=directory)
+            os.ftruncate(fd, buffer_size)
+            os.close(fd)
+            self.paths.append(path)
+            self.buffers.append(numpy.memmap(path, dtype=numpy.uint8, mode="r+", shape=(buffer_size,)))
+
+        self.free = list(range(buffer_count))
+
+    def acquire(self, shape, dtype, timeout=None):
+        """Take a free buffer from the pool, waiting until one is released if needed
+
+        Args:
+          shape: shape of the frame to store
+          dtype: numpy dtype of the frame to store
+          timeout: time in seconds to wait for a free buffer. None waits forever
+        Returns:
+          SharedFrame with a reference count of one
+        Raises:
+          ValueError if the frame does not fit in a buffer
+          WaitForResponseTimedOutError if no buffer was released within timeout
+        """
+        import numpy
+
+        dtype = numpy.dtype(dtype)
+        nbytes = dtype.itemsize
+        for dim in shape:
+            nbytes *= dim
+        if nbytes > self.buffer_size:
+            raise ValueError("Frame of %d bytes does not fit in %d byte buffer" % (nbytes, self.buffer_size))
+
+        deadline = None if timeout is None else time() + timeout
+        with self.lock:
+            while not self.free:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise WaitForResponseTimedOutError("No shared frame buffer was released in time")
+                self.lock.wait(remaining)
+            index = self.free.pop()
+
+        return SharedFrame(self, index, tuple(shape), dtype)
+
+    def load(self, image_path, timeout=None):
+        """Decode an image file into a shared frame.
+
+        The cv2 bindings cannot decode into a given buffer, so the image is
+        decoded into a temporary array and then copied into the pooled buffer.
+        The pool saves the allocation and the copy for every worker process
+        that maps the frame, not the decode allocation in this process.
+
+        Args:
+          image_path: relative path of image to decode
+          timeout: time in seconds to wait for a free buffer
+        Returns:
+          SharedFrame holding the decoded image
+        Raises:
+          IOError if the image could not be decoded
+        """
+        try:
+            import cv2
+        except:
+            raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
+
+        img = cv2.imread(image_path)
+        if img is None:
+            raise IOError("Could not decode image " + image_path)
+
+        frame = self.acquire(img.shape, img.dtype, timeout)
+        frame.array()[...] = img
+        return frame
+
+    def close(self):
+        """Unmap and remove all buffers of the pool"""
+        # Forked worker processes must not remove the buffers of their parent
+        if os.getpid() != self.pid:
+            return
+
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.buffers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TemplateIndex(object):
+    """On-disk index of precomputed ORB keypoints and descriptors of template images.
+    Entries are recomputed when the template file changes."""
+    def __init__(self, index_path=None, features=KEYPOINT_FEATURES):
+        self.index_path = index_path
+        self.features = features
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if index_path is not None and os.path.exists(index_path):
+            try:
+                with open(index_path, "rb") as index_file:
+                    index = cPickle.load(index_file)
+                if index.get("features") == features and index.get("padding") == KEYPOINT_PADDING:
+                    self.entries = dict(index["entries"])
+            except Exception, e:
+                # A corrupt index only costs recomputing the keypoints
+                debug("Ignoring unreadable template index %s: %s" % (index_path, str(e)))
+                self.entries = {}
+
+    def get(self, template_img_path):
+        """Get the keypoints and descriptors of a template image, computing and
+        saving them if the template is not indexed yet or has changed
+
+        Args:
+          template_img_path: relative path of template image
+        Returns:
+          (points, descriptors, (height, width)) of the template image
+        Raises:
+          IOError if the template image could not be read
+        """
+        return self.update([template_img_path])[0]
+
+    def update(self, template_img_paths):
+        """Make sure all given template images are indexed, saving the index once
+
+        Args:
+          template_img_paths: relative paths of template images
+        Returns:
+          list of (points, descriptors, (height, width)) in the order of template_img_paths
+        Raises:
+          IOError if a template image could not be read
+        """
+        entries = []
+        changed = False
+
+        for path in template_img_paths:
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            stamp = (stat.st_mtime, stat.st_size)
+
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, _template_keypoints(path, self.features))
+                changed = True
+                with self.lock:
+                    self.entries[key] = entry
+            entries.append(entry[1])
+
+        if changed:
+            self.save()
+
+        return entries
+
+    def save(self):
+        """Write the index to index_path, if one was given"""
+        if self.index_path is None:
+            return
+
+        with self.lock:
+            index = {"features": self.features, "padding": KEYPOINT_PADDING, "entries": dict(self.entries)}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as index_file:
+            cPickle.dump(index, index_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.index_path)
+
+class MatchProfile(object):
+    """Settings used by sub_image_search to compare a template with a screenshot"""
+    METHODS = ("TM_CCOEFF_NORMED", "TM_CCORR_NORMED", "TM_SQDIFF_NORMED")
+
+    def __init__(self, color=True, scale=1.0, method="TM_CCOEFF_NORMED"):
+        """
+        Args:
+          color: flag to determine if images are matched in color or in grayscale
+          scale: factor both images are resized by before matching, i.e. 0.5 for half resolution
+          method: name of the normalized cv2 template matching method to use
+        Raises:
+          ValueError if scale or method is invalid
+        """
+        if not 0 < scale <= 1:
+            raise ValueError("Match profile scale must be in (0, 1]: " + str(scale))
+        if method not in self.METHODS:
+            raise ValueError("Match profile method must be one of %s: %s" % (", ".join(self.METHODS), method))
+
+        self.color = color
+        self.scale = float(scale)
+        self.method = method
+
+    def __repr__(self):
+        return "MatchProfile(color=%r, scale=%r, method=%r)" % (self.color, self.scale, self.method)
+
+PROFILE_COLOR = MatchProfile()
+PROFILE_GRAY = MatchProfile(color=False)
+PROFILE_GRAY_HALF = MatchProfile(color=False, scale=0.5)
+
+_template_profiles = {}
+
 class DeviceUnderTest(object):
     """Class to describe the device under test using Android Debug Bridge (adb)"""
     def __init__(self, device_id, ir_remote=None, is_usb=False):
@@ -59,6 +459,8 @@ class DeviceUnderTest(object):
         self.serial_device = None
         self.child = None
         self.is_usb = is_usb
+        self.session = None
+        self.properties = {}
 
     def initialize_serial_device(self, serial_device_port=None, file_log=None):
         """Initialize a serial console device with the device under test
@@ -114,9 +516,9 @@ class DeviceUnderTest(object):
 
             press_command = "irsend SEND_ONCE " + self.ir_remote + " " + keyevent_id
 
-            run_command(press_command, 10, 0)
+            self._run_command(press_command, 10, 0)
 
-            sleep(delay)
+            self._sleep(delay)
 
     def get_specific_device_property(self, specific_property):
         """Get a specific device properties of the device under test
@@ -130,12 +532,99 @@ class DeviceUnderTest(object):
         """
         specific_prop = ""
         if self._is_device_ok():
-            specific_prop = str(run_command("adb -s " + self.device_id + " shell getprop " + specific_property, 10, 0))
+            specific_prop = str(self._run_command("adb -s " + self.device_id + " shell getprop " + specific_property, 10, 0))
 
         return specific_prop
 
+    def get_device_properties(self):
+        """Get all device properties of the device under test
+
+        Args:
+          nothing
+        Returns:
+          dictionary of android property names to their values
+        Raises:
+          nothing
+        """
+        properties = {}
+        if self._is_device_ok():
+            output = str(self._run_command("adb -s " + self.device_id + " shell getprop", 10, 0))
+            for line in output.splitlines():
+                match = re.match(r"^\[(.*)\]: \[(.*)\]", line)
+                if match:
+                    properties[match.group(1)] = match.group(2)
+
+        return properties
+
+    def warm_up(self, templates=None, ocr=True, root=False, index=None):
+        """Prepare a test session by loading libraries, template images, the OCR
+        engine and the device connection concurrently, so that the first test
+        step does not pay for them
+
+        Args:
+          templates: relative paths of template images to decode ahead of time
+          ocr: flag to determine if the OCR engine should be loaded
+          root: flag to determine if the device should be rooted instead of only connected
+          index: TemplateIndex to compute keypoints of templates into
+        Returns:
+          dictionary of part name to how long (seconds) it took
+        Raises:
+          any error raised while warming up a part
+        """
+        timings = {}
+        errors = []
+
+        def imports():
+            try:
+                import numpy
+                import cv2
+            except:
+                raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
+
+        def template_cache():
+            for path in templates:
+                profile = get_template_profile(path)
+                load_template(path, 1 if profile.color else 0, profile.scale)
+            if index is not None:
+                index.update(templates)
+
+        def device():
+            if root:
+                self.root_device()
+            self.properties = self.get_device_properties()
+
+        parts = [("imports", imports), ("device", device)]
+        if templates:
+            parts.append(("templates", template_cache))
+        if ocr:
+            parts.append(("ocr", _get_ocr_api))
+
+        def run(name, part):
+            start = time()
+            try:
+                part()
+            except:
+                errors.append(sys.exc_info())
+            timings[name] = time() - start
+
+        start = time()
+        threads = [threading.Thread(target=run, args=part) for part in parts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        timings["total"] = time() - start
+
+        for name in sorted(timings):
+            debug("warm up %s: %.3fs" % (name, timings[name]))
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        return timings
+
     def _is_device_ok(self):
-        output = run_command("adb -s " + self.device_id + " shell ls", 10, 0)
+        output = self._run_command("adb -s " + self.device_id + " shell ls", 10, 0)
 
         if "None" not in str(output) and "error" not in str(output):
             return True
@@ -154,7 +643,7 @@ class DeviceUnderTest(object):
         Raises:
           nothing
         """
-        run_command("adb -s " + self.device_id + " root", 10, 0)
+        self._run_command("adb -s " + self.device_id + " root", 10, 0)
 
         return self.reconnect_device()
 
@@ -183,16 +672,16 @@ class DeviceUnderTest(object):
                 self.child.sendline("")
                 self.child.sendline("netcfg eth0 dhcp")
                 self.child.expect(".*@(?:android|mt[0-9]+).*", timeout=10)
-                run_command("adb connect " + self.device_id, 10, 0)
+                self._run_command("adb connect " + self.device_id, 10, 0)
             except ExceptionPexpect, e:
                 sys.stderr.write('ERROR: %s\n' % str(e))
                 raise DeviceUnresponsiveError(e)
         elif self.is_usb is True:
-            run_command("adb -s " + self.device_id + " usb", 10, 0)
+            self._run_command("adb -s " + self.device_id + " usb", 10, 0)
         else:
-            run_command("adb connect " + self.device_id, 10, 0)
+            self._run_command("adb connect " + self.device_id, 10, 0)
 
-        output = run_command("adb -s " + self.device_id + " shell ls", 10, 0)
+        output = self._run_command("adb -s " + self.device_id + " shell ls", 10, 0)
 
         if "None" not in str(output) and "error" not in str(output):
             print("Device [" + self.device_id + "] is available after re-connecting.")
@@ -202,10 +691,10 @@ class DeviceUnderTest(object):
 
             while reconnect_attempts <= 3:
                 if self.is_usb is False:
-                    run_command("adb connect " + self.device_id, 10, 0)
+                    self._run_command("adb connect " + self.device_id, 10, 0)
                 else:
-                    run_command("adb -s " + self.device_id + " usb", 10, 0)
-                output = run_command("adb -s " + self.device_id + " shell ls", 10, 0)
+                    self._run_command("adb -s " + self.device_id + " usb", 10, 0)
+                output = self._run_command("adb -s " + self.device_id + " shell ls", 10, 0)
                 if "None" not in str(output) and "error" not in str(output):
                     print("Device [" + self.device_id + "] is available after re-connecting.")
                     success = True
@@ -241,10 +730,10 @@ class DeviceUnderTest(object):
                 sys.stderr.write('ERROR: %s\n' % str(e))
                 raise DeviceUnresponsiveError(e)
         else:
-            run_command("adb -s " + self.device_id + " reboot", 5, 0)
+            self._run_command("adb -s " + self.device_id + " reboot", 5, 0)
 
         # It may take up to 60 secs for a successful reboot
-        sleep(60)
+        self._sleep(60)
 
     def take_screenshot(self, file_name, folder_name):
         """Takes a screenshot on the device under test
@@ -258,19 +747,44 @@ class DeviceUnderTest(object):
           nothing
         """
         file_name = file_name + ".png"
+        frame_path = folder_name + "/" + file_name
 
-        screencap_command = "adb -s " + self.device_id + " shell /system/bin/screencap -p | sed 's/\r$//' > " + folder_name + "/" + file_name
+        screencap_command = "adb -s " + self.device_id + " shell /system/bin/screencap -p | sed 's/\r$//' > " + frame_path
 
         if self._is_device_ok():
+            if self.session is not None and self.session.replaying:
+                self.session.replay_frame(frame_path)
+                return frame_path
+
             screencap_out = str(run_command(screencap_command, 90, 0))
 
             # If screencap output is NoneType, try it once more
             if (screencap_out is "None" or "error" in screencap_out) and self._is_device_ok():
-                screencap_out = run_command(screencap_command, 90, 0)
+                screencap_out = str(run_command(screencap_command, 90, 0))
 
             debug("screencap result: " + screencap_out)
 
-        return folder_name + "/" + file_name
+            if self.session is not None:
+                self.session.record_frame(frame_path)
+
+        return frame_path
+
+    def take_shared_screenshot(self, file_name, folder_name, frame_pool, timeout=None):
+        """Takes a screenshot on the device under test and decodes it into a shared
+        memory buffer that worker processes can map without copying. Decoding
+        still uses a temporary array in this process, see FramePool.load
+
+        Args:
+          file_name: File name of image to be saved. Do not include the extension
+          folder_name: relative folder path of where image should be saved to
+          frame_pool: FramePool to take the buffer from
+          timeout: time in seconds to wait for a free buffer
+        Returns:
+          SharedFrame holding the screenshot. Call release() when done with it
+        Raises:
+          IOError if the screenshot could not be decoded
+        """
+        return frame_pool.load(self.take_screenshot(file_name, folder_name), timeout)
 
     def create_result_folder(self, folder_path):
         """Create a result folder
@@ -350,14 +864,14 @@ class DeviceUnderTest(object):
             press_command = "adb -s " + self.device_id + " shell input keyevent " + str(keyevent_id)
 
             if self._is_device_ok():
-                out = str(run_command(press_command, 10, 0))
+                out = str(self._run_command(press_command, 10, 0))
 
                 # Try again if press_command generates NoneType
                 if ("None" in out or "error" in out) and self._is_device_ok():
-                    out = str(run_command(press_command, 10, 0))
+                    out = str(self._run_command(press_command, 10, 0))
 
                 debug("command: " + str(press_command))
-                sleep(delay)
+                self._sleep(delay)
 
     def tap(self, x, y):
         """Perform a tap operation
@@ -372,7 +886,7 @@ class DeviceUnderTest(object):
         """
         if self._is_device_ok():
             tap_command = "adb -s " + self.device_id + " shell input tap %d %d" % (x, y)
-            run_command(tap_command, 5, 0)
+            self._run_command(tap_command, 5, 0)
 
     def drag(self, (x0, y0), (x1, y1), duration):
         """Perform a touch drag operation. A long press can be simulated by letting x0=x1 and y0=y1
@@ -388,30 +902,24 @@ class DeviceUnderTest(object):
         """
         if self._is_device_ok():
             drag_command = "adb -s " + self.device_id + " shell input touchscreen swipe %d %d %d %d %d" % (x0, y0, x1, y1, duration)
-            run_command(drag_command, 5, 0)
+            self._run_command(drag_command, 5, 0)
 
-    def tap_image(self, expected_image_path):
+    def tap_image(self, expected_image_path, method=MATCH_TEMPLATE, index=None, profile=None):
         """Perform a tap operation on a template image
 
         Args:
           expected_image_path: file path to template image to tap on
+          method: MATCH_TEMPLATE or MATCH_KEYPOINTS. See image_search
+          index: TemplateIndex with precomputed keypoints for MATCH_KEYPOINTS
+          profile: MatchProfile for MATCH_TEMPLATE. See sub_image_search
         Returns:
           nothing
         Raises:
           nothing
         """
-        try:
-            import cv2
-            import cv2.cv as cv
-        except:
-            raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
-
-        img = cv2.imread(expected_image_path, 0)
-        height, width = img.shape[:2]
-
         actual_image_path = strftime("IMAGE_%H%M%S", localtime())
         self.take_screenshot(actual_image_path, self.image_result_path)
-        result = sub_image_search(self.image_result_path + "/" + actual_image_path + ".png", expected_image_path)
+        result = image_search(self.image_result_path + "/" + actual_image_path + ".png", expected_image_path, method, index, profile)
         assert result[1] > TOLERANCE, expected_image_path + " was not found on screen."
         self.tap(result[3][0], (result[3][1]))
 
@@ -431,12 +939,19 @@ class DeviceUnderTest(object):
             os.mkdir(new_failure_dir)
 
         if self._is_device_ok():
-            pull_command = "adb -s " + self.device_id + " pull /data/anr/ " + new_failure_dir
-            out = run_command(pull_command, 60, 0)
-            debug(str(out))
+            try:
+                self.pull_tree("/data/anr", new_failure_dir + "/anr")
+            except SessionReplayError, e:
+                debug(str(e))
+            except DeviceUnresponsiveError, e:
+                # Older devices lack the tools pull_tree needs, fall back to adb pull
+                debug(str(e))
+                pull_command = "adb -s " + self.device_id + " pull /data/anr/ " + new_failure_dir
+                out = self._run_command(pull_command, 60, 0)
+                debug(str(out))
             self.take_screenshot(strftime("TEST_FAILURE_%H%M%S", localtime()), new_failure_dir)
             bugreport_dump = "adb -s " + self.device_id + " bugreport > " + new_failure_dir + "/bugreport.txt"
-            out = run_command(bugreport_dump, 240, 0)
+            out = self._run_command(bugreport_dump, 240, 0)
             debug(str(out))
 
     def android_command(self, command, timeout=30, retry=0):
@@ -454,10 +969,258 @@ class DeviceUnderTest(object):
         out = None
 
         if self._is_device_ok():
-            out = str(run_command("adb -s " + self.device_id + " " + command, timeout, retry))
+            out = str(self._run_command("adb -s " + self.device_id + " " + command, timeout, retry))
 
         return out
 
+    def pull_tree(self, remote_dir, local_dir, progress=None, chunk_size=TRANSFER_CHUNK_SIZE, timeout=300, retry=2):
+        """Copy a directory tree from the device under test as compressed tar streams.
+        Files whose content already matches on the host are skipped, so an
+        interrupted transfer can be resumed by calling pull_tree again.
+
+        Args:
+          remote_dir: directory on the device under test to copy
+          local_dir: directory on the host computer to copy into. Created if missing
+          progress: callable receiving (transferred_bytes, total_bytes) after each file
+          chunk_size: approximate number of bytes to send per tar stream
+          timeout: time (seconds) to wait for each tar stream
+          retry: number of attempts to retry a tar stream if it fails
+        Returns:
+          list of relative paths of files that were copied
+        Raises:
+          DeviceUnresponsiveError if the device cannot list remote_dir or a tar
+            stream still fails after retrying
+          SessionReplayError if a session is being replayed
+        """
+        if not self._is_device_ok():
+            raise DeviceUnresponsiveError("Device [" + self.device_id + "] is offline.")
+
+        # Consume the recorded listing before declining, to keep the replay in step
+        remote_files = self._remote_tree(remote_dir)
+
+        if self.session is not None and self.session.replaying:
+            raise SessionReplayError("Cannot pull " + remote_dir + " while replaying a session")
+
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+
+        local_hashes = _local_tree_hashes(local_dir)
+        needed = sorted(path for path, (size, md5) in remote_files.iteritems() if local_hashes.get(path) != md5)
+        sizes = dict((path, remote_files[path][0]) for path in needed)
+
+        def transfer(chunk, report):
+            cmd = "cd %s && tar -czf - %s" % (pipes.quote(remote_dir), " ".join(pipes.quote(path) for path in chunk))
+            pipe = subprocess.Popen(["adb", "-s", self.device_id, "exec-out", cmd], stdout=subprocess.PIPE)
+            received = set()
+            with _kill_after(pipe, timeout):
+                try:
+                    archive = tarfile.open(fileobj=pipe.stdout, mode="r|gz")
+                    for member in archive:
+                        if not member.isfile() or member.name.startswith("/") or ".." in member.name.split("/"):
+                            continue
+                        archive.extract(member, local_dir)
+                        received.add(_normalize_tree_path(member.name))
+                        report(_normalize_tree_path(member.name))
+                    archive.close()
+                except (tarfile.TarError, IOError, EOFError, zlib.error), e:
+                    debug("tar stream from device failed: " + str(e))
+                    pipe.stdout.close()
+                    pipe.wait()
+                    return -1
+                returncode = pipe.wait()
+
+            # exec-out does not pass on the exit status of tar, so check what arrived
+            missing = [path for path in chunk if path not in received]
+            if missing:
+                debug("%d files missing from tar stream: %s" % (len(missing), ", ".join(missing[:10])))
+                return -1
+            return returncode
+
+        return _transfer_tree(needed, sizes, transfer, progress, chunk_size, retry)
+
+    def push_tree(self, local_dir, remote_dir, progress=None, chunk_size=TRANSFER_CHUNK_SIZE, timeout=300, retry=2):
+        """Copy a directory tree to the device under test as compressed tar streams.
+        Files whose content already matches on the device are skipped, so an
+        interrupted transfer can be resumed by calling push_tree again.
+
+        Args:
+          local_dir: directory on the host computer to copy
+          remote_dir: directory on the device under test to copy into. Created if missing
+          progress: callable receiving (transferred_bytes, total_bytes) after each file
+          chunk_size: approximate number of bytes to send per tar stream
+          timeout: time (seconds) to wait for each tar stream
+          retry: number of attempts to retry a tar stream if it fails
+        Returns:
+          list of relative paths of files that were copied
+        Raises:
+          DeviceUnresponsiveError if the device cannot list remote_dir or a tar
+            stream still fails after retrying
+          SessionReplayError if a session is being replayed
+          IOError if local_dir is not a directory
+        """
+        if not os.path.isdir(local_dir):
+            raise IOError("Could not read directory " + local_dir)
+
+        if not self._is_device_ok():
+            raise DeviceUnresponsiveError("Device [" + self.device_id + "] is offline.")
+
+        # Consume the recorded listing before declining, to keep the replay in step
+        remote_files = self._remote_tree(remote_dir, create=True)
+
+        if self.session is not None and self.session.replaying:
+            raise SessionReplayError("Cannot push " + local_dir + " while replaying a session")
+
+        local_hashes = _local_tree_hashes(local_dir)
+        needed = sorted(path for path, md5 in local_hashes.iteritems()
+                        if path not in remote_files or remote_files[path][1] != md5)
+        sizes = dict((path, os.path.getsize(os.path.join(local_dir, path))) for path in needed)
+
+        def transfer(chunk, report):
+            cmd = "cd %s && tar -xzf -" % pipes.quote(remote_dir)
+            # exec-in forwards raw bytes and EOF, unlike shell on older adb versions
+            pipe = subprocess.Popen(["adb", "-s", self.device_id, "exec-in", cmd], stdin=subprocess.PIPE)
+            archive = None
+            with _kill_after(pipe, timeout):
+                try:
+                    archive = tarfile.open(fileobj=pipe.stdin, mode="w|gz")
+                    for path in chunk:
+                        archive.add(os.path.join(local_dir, path), path)
+                        report(path)
+                    archive.close()
+                    pipe.stdin.close()
+                except IOError, e:
+                    debug("tar stream to device failed: " + str(e))
+                    if archive is not None:
+                        # Keep the tar stream from flushing into the dead pipe when collected
+                        archive.fileobj.closed = True
+                    try:
+                        pipe.stdin.close()
+                    except IOError:
+                        pass
+                    pipe.wait()
+                    return -1
+                return pipe.wait()
+
+        copied = _transfer_tree(needed, sizes, transfer, progress, chunk_size, retry)
+
+        # exec-in does not pass on the exit status of tar, so check what arrived
+        if copied:
+            remote_files = self._remote_tree(remote_dir)
+            missing = [path for path in copied if remote_files.get(path, (0, None))[1] != local_hashes[path]]
+            if missing:
+                raise DeviceUnresponsiveError("%d files did not arrive on device: %s" % (len(missing), ", ".join(missing[:10])))
+
+        return copied
+
+    def _remote_tree(self, remote_dir, create=False):
+        # Maps relative path -> (size, md5) for every file below remote_dir
+        files = {}
+
+        for line in self._list_remote_tree(remote_dir, "stat -c '%s %n'", 60, create):
+            match = re.match(r"^(\d+) (.+)$", line)
+            if match:
+                files[_normalize_tree_path(match.group(2))] = (int(match.group(1)), None)
+
+        for line in self._list_remote_tree(remote_dir, "md5sum", 120, create):
+            match = re.match(r"^([0-9a-f]{32})\s+(.+)$", line)
+            if match:
+                path = _normalize_tree_path(match.group(2))
+                if path in files:
+                    files[path] = (files[path][0], match.group(1))
+
+        return files
+
+    def _list_remote_tree(self, remote_dir, exec_command, timeout, create):
+        # Run exec_command on every file below remote_dir. The marker is only
+        # printed if cd and find both worked, so missing tools are not mistaken
+        # for an empty directory.
+        cmd = "cd " + pipes.quote(remote_dir) + " && find . -type f -exec " + exec_command + " {} + && echo " + TREE_LIST_MARKER
+        if create:
+            cmd = "mkdir -p " + pipes.quote(remote_dir) + " && " + cmd
+
+        output = str(self._run_command("adb -s " + self.device_id + " shell " + pipes.quote(cmd), timeout, 0))
+        lines = [line.rstrip("\r") for line in output.splitlines()]
+
+        if TREE_LIST_MARKER not in lines:
+            raise DeviceUnresponsiveError("Could not list " + remote_dir + " on device: " + output.strip())
+
+        return lines
+
+    def record_session(self, archive_path):
+        """Start recording every command, its output and every screenshot taken
+        on the device under test into a session archive
+
+        Args:
+          archive_path: file path of session archive to write
+        Returns:
+          nothing
+        Raises:
+          nothing
+        """
+        self.close_session()
+        self.session = SessionRecorder(archive_path)
+
+    def replay_session(self, archive_path):
+        """Serve command outputs and screenshots from a recorded session archive
+        instead of the device under test. No device is needed and delays are skipped.
+
+        Args:
+          archive_path: file path of session archive previously written by record_session
+        Returns:
+          nothing
+        Raises:
+          SessionReplayError if archive is not a valid session archive
+        """
+        self.close_session()
+        self.session = SessionReplayer(archive_path)
+
+    def close_session(self):
+        """Stop recording or replaying a session. A recorded session archive is
+        only complete after it has been closed. This happens at the latest when
+        the interpreter exits, or when leaving a "with DeviceUnderTest(...)" block.
+
+        Args:
+          nothing
+        Returns:
+          nothing
+        Raises:
+          nothing
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close_session()
+
+    def _session_key(self, cmd):
+        # Result folders are timestamped, so replace them with placeholders to
+        # let a replayed run match the commands of the recorded run
+        for path, placeholder in ((self.image_result_path, "{IMAGE_RESULT}"),
+                                  (self.sub_folder_path, "{SUB_FOLDER}")):
+            cmd = cmd.replace(str(path), placeholder)
+        return cmd
+
+    def _run_command(self, cmd, timeout_time=None, retry_count=3):
+        if self.session is None:
+            return run_command(cmd, timeout_time, retry_count)
+
+        key = self._session_key(cmd)
+
+        if self.session.replaying:
+            return self.session.replay_command(key)
+
+        output = run_command(cmd, timeout_time, retry_count)
+        self.session.record_command(key, output)
+        return output
+
+    def _sleep(self, secs):
+        if self.session is None or not self.session.replaying:
+            sleep(secs)
+
 def match_text(device_under_test, text_dictionary, find=True):
     """Use OCR to match texts on a certain screen
 
@@ -510,29 +1273,60 @@ def __get_text_from_image(saved_image_path, coord):
     except:
         raise ImportError("tesseract library for python required")
 
-    api = tesseract.TessBaseAPI()
-    api.Init(".", "eng", tesseract.OEM_DEFAULT)
-    api.SetPageSegMode(tesseract.PSM_AUTO)
-
     image0 = cv2.imread(saved_image_path, cv.CV_LOAD_IMAGE_GRAYSCALE)
 
     if image0 is None:
         raise cv2.error("Image for text matching was NoneType")
+
+    return _get_text_from_array(image0, coord)
+
+def _get_text_from_array(image0, coord):
+    try:
+        import cv2.cv as cv
+        import tesseract
+    except:
+        raise ImportError("tesseract library for python required")
+
     # x1 = coord[0], y1 = coord[1], x2 = coord[2], y2 = coord[3]
     image1 = image0[coord[1]:coord[3], coord[0]:coord[2]]
     height1, width1 = image1.shape
     iplimage = cv.CreateImageHeader((width1, height1), cv.IPL_DEPTH_8U, 1)
     cv.SetData(iplimage, image1.tostring(), image1.dtype.itemsize * (width1))
-    tesseract.SetCvImage(iplimage, api)
-    return api.GetUTF8Text()
 
-def match_image(device_under_test, expected_image_paths, find=True):
+    # The engine is shared, so only one thread may use it at a time
+    with _ocr_lock:
+        api = _get_ocr_api()
+        tesseract.SetCvImage(iplimage, api)
+        return api.GetUTF8Text()
+
+def _get_ocr_api():
+    # Loading the Tesseract language model is slow, so do it once per process
+    global _ocr_api
+
+    with _ocr_lock:
+        if _ocr_api is None:
+            try:
+                import tesseract
+            except:
+                raise ImportError("tesseract library for python required")
+
+            api = tesseract.TessBaseAPI()
+            api.Init(".", "eng", tesseract.OEM_DEFAULT)
+            api.SetPageSegMode(tesseract.PSM_AUTO)
+            _ocr_api = api
+
+        return _ocr_api
+
+def match_image(device_under_test, expected_image_paths, find=True, method=MATCH_TEMPLATE, index=None, profile=None):
     """Test verification checkpoint after a test step has been executed
 
     Args:
       device_under_test: Current device under test
       expected_image_path: relative path to expected image to be found in template image.
       find: flag to determine if image should or should not be found on screen
+      method: MATCH_TEMPLATE or MATCH_KEYPOINTS. See image_search
+      index: TemplateIndex with precomputed keypoints for MATCH_KEYPOINTS
+      profile: MatchProfile for MATCH_TEMPLATE. See sub_image_search
     Returns:
       nothing
     Raises:
@@ -543,12 +1337,86 @@ def match_image(device_under_test, expected_image_paths, find=True):
     device_under_test.take_screenshot(actual_image_path, device_under_test.image_result_path)
 
     for expected_image_path in expected_image_paths:
-        result = sub_image_search(device_under_test.image_result_path + "/" + actual_image_path + ".png", expected_image_path)
+        result = image_search(device_under_test.image_result_path + "/" + actual_image_path + ".png", expected_image_path, method, index, profile)
         if find:
             assert result[1] > TOLERANCE, expected_image_path + " was not found on screen."
         else:
             assert result[1] < TOLERANCE, expected_image_path + " was found on screen."
 
+def _normalize_tree_path(path):
+    if path.startswith("./"):
+        path = path[2:]
+    return path
+
+def _local_tree_hashes(local_dir):
+    # Maps relative path -> md5 for every file below local_dir
+    hashes = {}
+
+    for root, dirs, files in os.walk(local_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            md5 = hashlib.md5()
+            with open(path, "rb") as tree_file:
+                for block in iter(lambda: tree_file.read(1024 * 1024), ""):
+                    md5.update(block)
+            hashes[os.path.relpath(path, local_dir).replace(os.sep, "/")] = md5.hexdigest()
+
+    return hashes
+
+def _transfer_tree(paths, sizes, transfer, progress, chunk_size, retry):
+    # Send paths in chunks through transfer(chunk, report), retrying failed chunks
+    total = sum(sizes.values())
+    done = []
+    state = {"bytes": 0}
+
+    def report(path):
+        if path in sizes:
+            done.append(path)
+            state["bytes"] += sizes[path]
+            if progress is not None:
+                progress(state["bytes"], total)
+
+    chunks = []
+    for path in paths:
+        if (not chunks or len(chunks[-1]) >= TRANSFER_CHUNK_FILES
+                or sum(sizes[p] for p in chunks[-1]) + sizes[path] > chunk_size):
+            chunks.append([])
+        chunks[-1].append(path)
+
+    for chunk in chunks:
+        attempts = 0
+        while True:
+            before = (len(done), state["bytes"])
+            returncode = transfer(chunk, report)
+            if returncode == 0:
+                break
+
+            # Forget the files of the failed stream, they will be sent again
+            del done[before[0]:]
+            state["bytes"] = before[1]
+            attempts += 1
+            debug("tar stream returned %s, attempt %d" % (str(returncode), attempts))
+            if attempts > retry:
+                raise DeviceUnresponsiveError("Transfer of %d files failed after %d attempts" % (len(chunk), attempts))
+
+    return done
+
+@contextmanager
+def _kill_after(pipe, timeout):
+    # Kill pipe if it is still running after timeout seconds
+    def kill():
+        try:
+            pipe.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+
 def debug(msg):
     """Print debug messages to stderr. Set _debug_level to > 0 to enable
 
@@ -716,16 +1584,40 @@ def select_device():
 
     return device_id
 
-def sub_image_search(source_img_path, template_img_path):
+def image_search(source_img_path, template_img_path, method=MATCH_TEMPLATE, index=None, profile=None):
+    """Search for a sub image with the given matching method
+
+    Args:
+      source_img_path: relative path of image to be found in template image
+      template_img_path: relative path of template image used to find subimage within it
+      method: MATCH_TEMPLATE for sub_image_search or MATCH_KEYPOINTS for keypoint_image_search
+      index: TemplateIndex with precomputed keypoints for MATCH_KEYPOINTS
+      profile: MatchProfile for MATCH_TEMPLATE
+    Returns:
+      (min_val, max_val, min_loc, max_loc) as returned by sub_image_search
+    Raises:
+      ValueError if method is unknown
+    """
+    if method == MATCH_TEMPLATE:
+        return sub_image_search(source_img_path, template_img_path, profile)
+    elif method == MATCH_KEYPOINTS:
+        return keypoint_image_search(source_img_path, template_img_path, index)
+    else:
+        raise ValueError("Unknown image matching method: " + str(method))
+
+def sub_image_search(source_img_path, template_img_path, profile=None):
     """Attempts to search for a sub image within a given template image
 
     Args:
       source_img_path: relative path of image to be found in template image
       template_img_path: relative path of template image used to find subimage within it
+      profile: MatchProfile to match with. Defaults to the profile set for the
+        template with set_template_profile, or PROFILE_COLOR
     Returns:
-      normalized cross correlation value of the match of the image within the template image
+      normalized cross correlation value of the match of the image within the template image.
+      Locations are in full resolution coordinates whatever the profile scale is
     Raises:
-      nothing
+      IOError if the source image could not be read
     """
 
     try:
@@ -733,9 +1625,284 @@ def sub_image_search(source_img_path, template_img_path):
     except:
         raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
 
-    img = cv2.imread(source_img_path)
-    template = cv2.imread(template_img_path)
-    result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+    profile = get_template_profile(template_img_path, profile)
+    # Decoding straight to grayscale is cheaper than converting afterwards
+    img = cv2.imread(source_img_path, 1 if profile.color else 0)
+    if img is None:
+        raise IOError("Could not read image " + source_img_path)
+    return _search_array(img, template_img_path, profile)
+
+def _search_array(img, template_img_path, profile):
+    import cv2
+
+    if not profile.color and len(img.shape) > 2:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if profile.scale != 1.0:
+        img = cv2.resize(img, None, fx=profile.scale, fy=profile.scale, interpolation=cv2.INTER_AREA)
+
+    template = load_template(template_img_path, 1 if profile.color else 0, profile.scale)
+    (min_x, max_y, minloc, maxloc) = _match_template(img, template, profile.method)
+
+    if profile.scale != 1.0:
+        minloc = (int(round(minloc[0] / profile.scale)), int(round(minloc[1] / profile.scale)))
+        maxloc = (int(round(maxloc[0] / profile.scale)), int(round(maxloc[1] / profile.scale)))
+    return (min_x, max_y, minloc, maxloc)
+
+def _match_template(img, template, method="TM_CCOEFF_NORMED"):
+    import cv2
+
+    result = cv2.matchTemplate(img, template, getattr(cv2, method))
+    if method == "TM_SQDIFF_NORMED":
+        # Lower is better for squared differences, turn it into a similarity
+        result = 1.0 - result
     (min_x, max_y, minloc, maxloc) = cv2.minMaxLoc(result)
     debug("min_x: %s max_y: %s minloc: %s maxloc: %s" % (str(min_x), str(max_y), str(minloc), str(maxloc)))
     return (min_x, max_y, minloc, maxloc)
+
+def set_template_profile(template_img_path, profile):
+    """Set the MatchProfile sub_image_search uses for a template image when none is given
+
+    Args:
+      template_img_path: relative path of template image
+      profile: MatchProfile to use for the template, or None to use PROFILE_COLOR again
+    Returns:
+      nothing
+    Raises:
+      nothing
+    """
+    key = os.path.abspath(template_img_path)
+    if profile is None:
+        _template_profiles.pop(key, None)
+    else:
+        _template_profiles[key] = profile
+
+def get_template_profile(template_img_path, profile=None):
+    """Get the MatchProfile to use for a template image
+
+    Args:
+      template_img_path: relative path of template image
+      profile: MatchProfile given for the call, which takes precedence
+    Returns:
+      MatchProfile to match the template with
+    Raises:
+      nothing
+    """
+    if profile is not None:
+        return profile
+    return _template_profiles.get(os.path.abspath(template_img_path), PROFILE_COLOR)
+
+def parallel_sub_image_search(process_pool, frame, template_img_paths, profile=None):
+    """Search for several template images within a shared frame using a pool of
+    worker processes. Workers map the frame buffer directly instead of receiving a copy.
+
+    Args:
+      process_pool: multiprocessing.Pool to run the searches on
+      frame: SharedFrame holding the screenshot to search in
+      template_img_paths: relative paths of template images to find within the frame
+      profile: MatchProfile to match with. See sub_image_search
+    Returns:
+      list of sub_image_search results, in the order of template_img_paths
+    Raises:
+      nothing
+    """
+    frame.retain()
+    try:
+        return process_pool.map(_shared_sub_image_search,
+                                [(frame.handle(), path, get_template_profile(path, profile))
+                                 for path in template_img_paths])
+    finally:
+        frame.release()
+
+def parallel_extract_text(process_pool, frame, text_coords):
+    """Use OCR to extract texts from a shared frame using a pool of worker processes
+
+    Args:
+      process_pool: multiprocessing.Pool to run the text extraction on
+      frame: SharedFrame holding the screenshot to extract texts from
+      text_coords: 2-d array of coordinates of texts to extract
+    Returns:
+      texts that are extracted from given coordinates
+    Raises:
+      nothing
+    """
+    frame.retain()
+    try:
+        return process_pool.map(_shared_extract_text,
+                                [(frame.handle(), coord) for coord in text_coords])
+    finally:
+        frame.release()
+
+def _shared_sub_image_search(args):
+    handle, template_img_path, profile = args
+    return _search_array(map_shared_frame(handle), template_img_path, profile)
+
+def _shared_extract_text(args):
+    import cv2
+
+    handle, coord = args
+    image0 = map_shared_frame(handle)
+    if len(image0.shape) > 2:
+        image0 = cv2.cvtColor(image0, cv2.COLOR_BGR2GRAY)
+    return _get_text_from_array(image0, coord).strip()
+
+def map_shared_frame(handle):
+    """Map a shared frame into the current process without copying it
+
+    Args:
+      handle: handle returned by SharedFrame.handle()
+    Returns:
+      read-only numpy array of the frame
+    Raises:
+      nothing
+    """
+    import numpy
+
+    path, shape, dtype = handle
+    return numpy.memmap(path, dtype=numpy.dtype(dtype), mode="r", shape=shape)
+
+def keypoint_image_search(source_img_path, template_img_path, index=None):
+    """Attempts to search for a sub image using ORB keypoints. Unlike sub_image_search
+    the sub image is found even if it is rendered at a different scale.
+
+    Args:
+      source_img_path: relative path of image to be found in template image
+      template_img_path: relative path of template image used to find subimage within it
+      index: TemplateIndex to take precomputed template keypoints from. Keypoints
+        are computed on every call if None
+    Returns:
+      (min_val, max_val, min_loc, max_loc) like sub_image_search. The value is the
+      normalized cross correlation of the template with the matched region warped
+      back to template size, and the location is the top left corner of the region.
+      Values are 0 if not enough keypoints matched.
+    Raises:
+      nothing
+    """
+    try:
+        import cv2
+        import numpy
+    except:
+        raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
+
+    not_found = (0.0, 0.0, (0, 0), (0, 0))
+
+    if index is None:
+        template_points, template_desc, (height, width) = _template_keypoints(template_img_path, KEYPOINT_FEATURES)
+    else:
+        template_points, template_desc, (height, width) = index.get(template_img_path)
+
+    img = _read_gray(source_img_path)
+    img_points, img_desc, _ = _compute_keypoints(img, KEYPOINT_FEATURES)
+
+    if template_desc is None or img_desc is None or len(img_points) < 2:
+        return not_found
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    good = [m[0] for m in matcher.knnMatch(template_desc, img_desc, k=2)
+            if len(m) == 2 and m[0].distance < KEYPOINT_RATIO * m[1].distance]
+    debug("keypoint matches: %d of %d" % (len(good), len(template_points)))
+
+    if len(good) < KEYPOINT_MIN_MATCHES:
+        if len(template_points) < KEYPOINT_MIN_MATCHES:
+            debug("%s has only %d keypoints, too few to ever match" % (template_img_path, len(template_points)))
+        return not_found
+
+    src = numpy.float32([template_points[m.queryIdx] for m in good]).reshape(-1, 1, 2)
+    dst = numpy.float32([img_points[m.trainIdx] for m in good]).reshape(-1, 1, 2)
+    if hasattr(cv2, "estimateAffinePartial2D"):
+        # The same UI element at another resolution only differs in scale and
+        # position, and the tighter model stays accurate with few matches
+        affine, _ = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC, ransacReprojThreshold=5.0)
+        homography = None if affine is None else numpy.vstack([affine, [0, 0, 1]])
+    else:
+        homography, _ = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+
+    if homography is None:
+        return not_found
+
+    corners = numpy.float32([[0, 0], [width, 0], [width, height], [0, height]]).reshape(-1, 1, 2)
+    x, y, _, _ = cv2.boundingRect(cv2.perspectiveTransform(corners, homography).astype(numpy.int32))
+    # The projected region may be partly off screen, keep the location tappable
+    x = min(max(x, 0), img.shape[1] - 1)
+    y = min(max(y, 0), img.shape[0] - 1)
+
+    # Score the match the same way as sub_image_search so TOLERANCE still applies
+    region = cv2.warpPerspective(img, homography, (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    score = float(cv2.matchTemplate(region, load_template(template_img_path, 0), cv2.TM_CCOEFF_NORMED)[0][0])
+    debug("keypoint score: %s loc: %s" % (str(score), str((x, y))))
+    return (score, score, (x, y), (x, y))
+
+def load_template(template_img_path, flags=1, scale=1.0):
+    """Decode a template image, reusing the decoded image while the file is unchanged
+
+    Args:
+      template_img_path: relative path of template image
+      flags: cv2.imread flags. 1 loads in color, 0 in grayscale
+      scale: factor to resize the decoded template by
+    Returns:
+      decoded template image. Must not be modified
+    Raises:
+      IOError if the template image could not be read
+      ValueError if the template would be smaller than one pixel after scaling
+    """
+    try:
+        import cv2
+    except:
+        raise ImportError("cv2 library required. Type \"sudo apt-get install python-numpy python-opencv\" to install")
+
+    stat = os.stat(template_img_path)
+    key = (os.path.abspath(template_img_path), flags, scale)
+    stamp = (stat.st_mtime, stat.st_size)
+
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    template = cv2.imread(template_img_path, flags)
+    if template is None:
+        raise IOError("Could not read image " + template_img_path)
+    if scale != 1.0:
+        height, width = template.shape[:2]
+        if int(round(width * scale)) < 1 or int(round(height * scale)) < 1:
+            raise ValueError("Template %s (%dx%d) is too small to scale by %s" % (template_img_path, width, height, str(scale)))
+        template = cv2.resize(template, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    with _template_cache_lock:
+        _template_cache[key] = (stamp, template)
+    return template
+
+def _read_gray(image_path):
+    import cv2
+
+    img = cv2.imread(image_path, 0)
+    if img is None:
+        raise IOError("Could not read image " + image_path)
+    return img
+
+def _template_keypoints(template_img_path, features):
+    template = load_template(template_img_path, 0)
+    # ORB ignores a border as wide as its patch, which is most of an icon sized
+    # template, so extend the edges before detecting keypoints
+    keypoints = _compute_keypoints(template, features, KEYPOINT_PADDING)
+
+    if len(keypoints[0]) < KEYPOINT_MIN_MATCHES:
+        debug("Template %s has only %d keypoints, at least %d are needed to match it" %
+              (template_img_path, len(keypoints[0]), KEYPOINT_MIN_MATCHES))
+    return keypoints
+
+def _compute_keypoints(img, features, padding=0):
+    import cv2
+    import numpy
+
+    if hasattr(cv2, "ORB_create"):
+        orb = cv2.ORB_create(features)
+    else:
+        orb = cv2.ORB(features)
+
+    padded = img
+    if padding:
+        padded = cv2.copyMakeBorder(img, padding, padding, padding, padding, cv2.BORDER_REPLICATE)
+
+    keypoints, descriptors = orb.detectAndCompute(padded, None)
+    points = numpy.float32([kp.pt for kp in keypoints]).reshape(-1, 2) - padding
+    return (points, descriptors, img.shape[:2])
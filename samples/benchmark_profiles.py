@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Compare speed and accuracy of sub_image_search match profiles.
+
+Usage: benchmark_profiles.py [-n RUNS] screenshot.png template.png [template.png ...]
+
+PROFILE_COLOR is the reference. For every other profile the location error
+is the distance (pixels) between its match and the reference match.
+"""
+
+import argparse
+import math
+import os
+from time import time
+
+from pyint import pyinttestdroid
+
+PROFILES = [
+    ("color", pyinttestdroid.PROFILE_COLOR),
+    ("gray", pyinttestdroid.PROFILE_GRAY),
+    ("color_half", pyinttestdroid.MatchProfile(scale=0.5)),
+    ("gray_half", pyinttestdroid.PROFILE_GRAY_HALF),
+    ("gray_quarter", pyinttestdroid.MatchProfile(color=False, scale=0.25)),
+    ("gray_half_ccorr", pyinttestdroid.MatchProfile(color=False, scale=0.5, method="TM_CCORR_NORMED")),
+]
+
+def benchmark(screenshot, templates, runs):
+    reference = {}
+
+    print("%-16s %-24s %10s %8s %8s %6s" % ("profile", "template", "ms/match", "score", "loc err", "found"))
+
+    for name, profile in PROFILES:
+        for template in templates:
+            # Keep the template decode out of the timing
+            result = pyinttestdroid.sub_image_search(screenshot, template, profile)
+
+            start = time()
+            for i in range(runs):
+                result = pyinttestdroid.sub_image_search(screenshot, template, profile)
+            elapsed = (time() - start) / runs
+
+            if profile is pyinttestdroid.PROFILE_COLOR:
+                reference[template] = result[3]
+            ref = reference[template]
+            error = math.hypot(result[3][0] - ref[0], result[3][1] - ref[1])
+
+            print("%-16s %-24s %10.2f %8.4f %8.1f %6s" % (name, os.path.basename(template), elapsed * 1000,
+                                                         result[1], error, result[1] > pyinttestdroid.TOLERANCE))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare sub_image_search match profiles")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="matches to time per profile and template")
+    parser.add_argument("screenshot", help="screenshot to search in")
+    parser.add_argument("templates", nargs="+", help="template images to search for")
+    args = parser.parse_args()
+
+    pyinttestdroid._debug_level = 0
+    benchmark(args.screenshot, args.templates, args.runs)